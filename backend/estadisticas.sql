@@ -0,0 +1,46 @@
+-- Estadísticas precalculadas para los endpoints de estadísticas y gráficas. La
+-- API ejecuta este archivo al arrancar, después de indices.sql (es idempotente),
+-- y refresca las vistas con REFRESH MATERIALIZED VIEW CONCURRENTLY después de
+-- cada escritura, lo que requiere un índice único en cada vista
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_stats_productos AS
+SELECT
+    1 AS id,
+    COUNT(*) AS total,
+    COALESCE(SUM(precio * cantidad), 0) AS valor_total,
+    COUNT(*) FILTER (WHERE cantidad < 10) AS stock_bajo,
+    COUNT(*) FILTER (WHERE cantidad = 0) AS sin_stock,
+    COALESCE(SUM(cantidad), 0) AS cantidad_total,
+    COALESCE(AVG(precio), 0) AS precio_promedio,
+    COUNT(DISTINCT categoria) FILTER (WHERE categoria IS NOT NULL AND categoria <> '') AS total_categorias
+FROM productos;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_stats_productos ON mv_stats_productos(id);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_stats_categorias AS
+SELECT
+    COALESCE(NULLIF(categoria, ''), 'Sin categoría') AS categoria,
+    COUNT(*) AS cantidad,
+    SUM(precio * cantidad) AS valor_total
+FROM productos
+GROUP BY 1;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_stats_categorias ON mv_stats_categorias(categoria);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_stats_rangos_precio AS
+SELECT
+    orden,
+    (ARRAY['< $50', '$50 - $100', '$100 - $500', '$500 - $1000', '> $1000'])[orden] AS rango,
+    COUNT(*) AS cantidad
+FROM (
+    SELECT CASE
+        WHEN precio < 50 THEN 1
+        WHEN precio < 100 THEN 2
+        WHEN precio < 500 THEN 3
+        WHEN precio < 1000 THEN 4
+        ELSE 5
+    END AS orden
+    FROM productos
+) AS rangos
+GROUP BY orden;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_stats_rangos_precio ON mv_stats_rangos_precio(orden);
@@ -0,0 +1,14 @@
+-- Índices de productos posteriores a init.sql. La API ejecuta este archivo al
+-- arrancar (es idempotente), así también llegan a las bases ya inicializadas,
+-- donde init.sql no vuelve a ejecutarse
+
+-- Gráficas de stock bajo y productos más valiosos: ambas leen los primeros 10
+-- productos del índice en lugar de ordenar la tabla completa. El de cantidad
+-- incluye las columnas que devuelve la consulta para resolverla sólo con el índice
+CREATE INDEX IF NOT EXISTS idx_cantidad ON productos(cantidad) INCLUDE (codigo, nombre, precio);
+CREATE INDEX IF NOT EXISTS idx_valor_total ON productos((precio * cantidad) DESC);
+
+-- Incluye id para filtrar por categoría y paginar por id en el mismo índice.
+-- Reemplaza al idx_categoria de una sola columna de las bases anteriores
+CREATE INDEX IF NOT EXISTS idx_categoria_id ON productos(categoria, id);
+DROP INDEX IF EXISTS idx_categoria;
@@ -14,9 +14,11 @@ CREATE TABLE IF NOT EXISTS productos (
     CONSTRAINT check_nombre_no_vacio CHECK (LENGTH(TRIM(nombre)) > 0)
 );
 
-CREATE INDEX idx_codigo ON productos(codigo);
-CREATE INDEX idx_categoria ON productos(categoria);
+-- La restricción UNIQUE de codigo ya crea su índice btree (productos_codigo_key),
+-- que usan las búsquedas por código y los ON CONFLICT (codigo)
 CREATE INDEX idx_nombre ON productos(nombre);
+-- Los índices agregados después de la primera versión están en indices.sql; la
+-- API los crea al arrancar si no existen, también en bases ya inicializadas
 
 CREATE OR REPLACE FUNCTION actualizar_fecha_modificacion()
 RETURNS TRIGGER AS $$
@@ -37,3 +39,6 @@ INSERT INTO productos (codigo, nombre, descripcion, cantidad, precio, categoria)
 ('PROD003', 'Teclado Mecánico Keychron K2', 'Teclado mecánico retroiluminado', 15, 89.99, 'Accesorios'),
 ('PROD004', 'Monitor LG 27 4K', 'Monitor 4K UHD 27 pulgadas', 8, 449.99, 'Electrónica'),
 ('PROD005', 'Webcam Logitech C920', 'Webcam Full HD 1080p', 20, 79.99, 'Accesorios');
+
+-- Las vistas materializadas de estadísticas están en estadisticas.sql y también
+-- se crean al arrancar la API
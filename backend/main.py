@@ -1,22 +1,204 @@
-from fastapi import FastAPI, HTTPException, status, File, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, status, File, UploadFile, WebSocket, WebSocketDisconnect, Depends, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse as BaseORJSONResponse
 from pydantic import BaseModel, Field, validator
 from typing import Optional, List
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from decimal import Decimal
+import asyncpg
 import os
 import time
 import pandas as pd
-import io
+import numpy as np
+import orjson
 import asyncio
+import hashlib
+from python_calamine import CalamineWorkbook
+from cachetools import TTLCache
+
+def _orjson_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Tipo no serializable: {type(obj).__name__}")
+
+def _orjson_dumps(content) -> bytes:
+    return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+class ORJSONResponse(BaseORJSONResponse):
+    """Respuesta serializada con orjson; los NUMERIC de PostgreSQL se envían como float"""
+    def render(self, content) -> bytes:
+        return _orjson_dumps(content)
+
+# Configuración de base de datos. Por defecto se conecta a través de PgBouncer en
+# modo transacción, que no conserva sentencias preparadas entre transacciones
+DB_CONFIG = {
+    'host': os.getenv('DB_HOST', 'pgbouncer'),
+    'port': int(os.getenv('DB_PORT', '6432')),
+    'database': os.getenv('DB_NAME', 'inventario'),
+    'user': os.getenv('DB_USER', 'admin'),
+    'password': os.getenv('DB_PASSWORD', 'admin123'),
+    'statement_cache_size': int(os.getenv('DB_STATEMENT_CACHE_SIZE', '0'))
+}
+
+async def _crear_pool():
+    """Crea el pool de conexiones a la base de datos con reintentos"""
+    max_retries = 5
+    retry_delay = 2
+    
+    for attempt in range(max_retries):
+        try:
+            return await asyncpg.create_pool(
+                **DB_CONFIG, min_size=2, max_size=10, max_inactive_connection_lifetime=300
+            )
+        except (OSError, asyncpg.PostgresError) as e:
+            if attempt < max_retries - 1:
+                print(f"Intento {attempt + 1} fallido. Reintentando en {retry_delay} segundos...")
+                await asyncio.sleep(retry_delay)
+            else:
+                raise
+
+async def _ping(pool):
+    """Toma una conexión del pool y verifica que responda"""
+    conn = await pool.acquire()
+    try:
+        await conn.fetchval("SELECT 1")
+    except BaseException:
+        # También si la tarea se cancela: la conexión no debe quedar fuera del pool
+        await pool.release(conn)
+        raise
+    return conn
+
+# Vistas materializadas que respaldan los endpoints de estadísticas y gráficas
+VISTAS_ESTADISTICAS = ('mv_stats_productos', 'mv_stats_categorias', 'mv_stats_rangos_precio')
+
+# DDL idempotente que se aplica al arrancar, en este orden: init.sql sólo se
+# ejecuta sobre un volumen vacío y no llega a las bases ya inicializadas
+ESQUEMA_SQL = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), archivo)
+    for archivo in ('indices.sql', 'estadisticas.sql')
+]
+
+# Segundos que se esperan tras una escritura antes de refrescar las vistas, para
+# agrupar en un solo refresco las escrituras que llegan seguidas
+REFRESCO_ESPERA = 2.0
+
+estadisticas_pendientes = asyncio.Event()
+
+def marcar_estadisticas_pendientes():
+    estadisticas_pendientes.set()
+
+async def actualizar_esquema(pool):
+    """Crea los índices y las vistas de estadísticas que falten (ESQUEMA_SQL)"""
+    sentencias = []
+    for ruta in ESQUEMA_SQL:
+        with open(ruta, encoding='utf-8') as f:
+            sentencias.append(f.read())
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            # Si arrancan varios workers a la vez, sólo uno aplica el DDL
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('esquema_inventario'))")
+            for sql in sentencias:
+                await conn.execute(sql)
+
+async def refrescar_estadisticas(pool):
+    """Refresca las vistas de estadísticas cuando hubo escrituras.
+    
+    No se usa LISTEN/NOTIFY porque PgBouncer en modo transacción no mantiene la
+    sesión que escucha; las escrituras de la API marcan las vistas como pendientes.
+    """
+    while True:
+        await estadisticas_pendientes.wait()
+        await asyncio.sleep(REFRESCO_ESPERA)
+        estadisticas_pendientes.clear()
+        try:
+            async with pool.acquire() as conn:
+                for vista in VISTAS_ESTADISTICAS:
+                    await conn.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {vista}")
+            ESTADISTICAS_CACHE.clear()
+        except ERRORES_CONEXION as e:
+            print(f"Error refrescando estadísticas: {e}")
+            estadisticas_pendientes.set()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Crea el pool y calienta sus conexiones en paralelo antes de atender
+    peticiones; lo cierra al apagar la aplicación"""
+    pool = await _crear_pool()
+    
+    # Las conexiones se retienen hasta que todos los pings terminan para que cada
+    # tarea use una conexión distinta del pool
+    conexiones = await asyncio.gather(*[_ping(pool) for _ in range(pool.get_min_size())])
+    for conn in conexiones:
+        await pool.release(conn)
+    
+    await actualizar_esquema(pool)
+    
+    app.state.pool = pool
+    refresco = asyncio.create_task(refrescar_estadisticas(pool))
+    try:
+        yield
+    finally:
+        refresco.cancel()
+        await pool.close()
 
 app = FastAPI(
     title="Sistema de Inventario API",
     description="API REST para gestión de inventario con validaciones completas",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
+MAX_EXCEL_SIZE = 10 * 1024 * 1024
+
+class LimiteTamanoExcel:
+    """Corta las subidas de Excel que superan MAX_EXCEL_SIZE mientras se reciben.
+    
+    Starlette guarda el cuerpo completo antes de que el endpoint lo vea, así que
+    el límite se aplica aquí, sobre los bytes que llegan: con Content-Length se
+    rechaza sin leer nada, y sin él (subidas chunked) se cuentan los bytes de
+    cada mensaje http.request y se responde 413 al pasar el límite.
+    """
+    # Margen para los encabezados del multipart que envuelven al archivo
+    LIMITE = MAX_EXCEL_SIZE + 64 * 1024
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].endswith('-excel'):
+            await self.app(scope, receive, send)
+            return
+        
+        content_length = dict(scope['headers']).get(b'content-length', b'')
+        if content_length.isdigit() and int(content_length) > self.LIMITE:
+            respuesta = ORJSONResponse(
+                {"detail": "El archivo excede el tamaño máximo de 10 MB"},
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+            await respuesta(scope, receive, send)
+            return
+        
+        recibidos = 0
+        
+        async def receive_limitado():
+            nonlocal recibidos
+            message = await receive()
+            if message['type'] == 'http.request':
+                recibidos += len(message.get('body', b''))
+                if recibidos > self.LIMITE:
+                    # FastAPI deja pasar las HTTPException que surgen al leer el cuerpo
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail="El archivo excede el tamaño máximo de 10 MB"
+                    )
+            return message
+        
+        await self.app(scope, receive_limitado, send)
+
+app.add_middleware(LimiteTamanoExcel)
+
 # Configuración de CORS
 app.add_middleware(
     CORSMiddleware,
@@ -26,58 +208,132 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configuración de base de datos
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'db'),
-    'port': os.getenv('DB_PORT', '5432'),
-    'database': os.getenv('DB_NAME', 'inventario'),
-    'user': os.getenv('DB_USER', 'admin'),
-    'password': os.getenv('DB_PASSWORD', 'admin123')
-}
+ERRORES_CONEXION = (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError)
 
-def get_db_connection():
-    """Obtiene conexión a la base de datos con reintentos"""
-    max_retries = 5
-    retry_delay = 2
+async def _tomar_conexion(pool):
+    """Toma una conexión del pool comprobando que siga viva.
     
-    for attempt in range(max_retries):
+    Si no responde al ping se descarta y se toma otra una sola vez, sin esperas:
+    los reintentos con pausa sólo ocurren al arrancar, en _crear_pool.
+    """
+    for intento in range(2):
+        conn = await pool.acquire(timeout=10)
         try:
-            conn = psycopg2.connect(**DB_CONFIG, cursor_factory=RealDictCursor)
+            await conn.fetchval("SELECT 1", timeout=0.5)
             return conn
-        except psycopg2.OperationalError as e:
-            if attempt < max_retries - 1:
-                print(f"Intento {attempt + 1} fallido. Reintentando en {retry_delay} segundos...")
-                time.sleep(retry_delay)
-            else:
-                raise HTTPException(
-                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                    detail="No se pudo conectar a la base de datos"
-                )
+        except ERRORES_CONEXION:
+            conn.terminate()
+            await pool.release(conn)
+            if intento == 1:
+                raise
+        except BaseException:
+            # Cancelación (cliente desconectado, apagado) u otro error: la
+            # conexión vuelve al pool antes de propagarlo
+            await pool.release(conn)
+            raise
+
+@asynccontextmanager
+async def conexion_db(pool):
+    """Toma una conexión viva del pool (503 si no hay) y la devuelve al salir"""
+    try:
+        conn = await _tomar_conexion(pool)
+    except ERRORES_CONEXION:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="No se pudo conectar a la base de datos"
+        )
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+async def get_db(request: Request):
+    """Toma una conexión del pool y la devuelve al terminar la petición"""
+    async with conexion_db(request.app.state.pool) as conn:
+        yield conn
+
+# Clientes WebSocket a los que se envía en paralelo en cada grupo, y segundos
+# que se espera a cada uno antes de darlo por desconectado
+ENVIO_GRUPO = 50
+ENVIO_TIMEOUT = 2.0
 
 # Gestor de conexiones WebSocket
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: set[WebSocket] = set()
+        # Referencias a las tareas en curso para que no las recolecte el GC
+        self._tareas: set[asyncio.Task] = set()
+        self._pendiente: Optional[dict] = None
+        self._envio: Optional[asyncio.Task] = None
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        self.active_connections.discard(websocket)
 
     async def send_progress(self, message: dict):
-        disconnected = []
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except Exception as e:
-                print(f"Error enviando mensaje: {e}")
-                disconnected.append(connection)
+        if not self.active_connections:
+            return
+        
+        # Se serializa una sola vez para todos los clientes, con el mismo orjson
+        # de las respuestas HTTP. Se envía como texto porque el cliente hace
+        # JSON.parse de event.data, que con send_bytes sería un Blob
+        payload = _orjson_dumps(message).decode()
+        
+        # Los envíos de cada grupo se hacen en paralelo y con tiempo límite: un
+        # cliente lento no retrasa al resto y se desconecta en lugar de acumular
+        # mensajes pendientes. Entre grupos se cede el event loop
+        conexiones = list(self.active_connections)
+        for inicio in range(0, len(conexiones), ENVIO_GRUPO):
+            grupo = conexiones[inicio:inicio + ENVIO_GRUPO]
+            resultados = await asyncio.gather(
+                *[asyncio.wait_for(c.send_text(payload), timeout=ENVIO_TIMEOUT) for c in grupo],
+                return_exceptions=True
+            )
+            fallidas = []
+            for connection, resultado in zip(grupo, resultados):
+                if isinstance(resultado, Exception):
+                    print(f"Error enviando mensaje: {resultado!r}")
+                    self.disconnect(connection)
+                    fallidas.append(connection)
+            # Los cierres corren aparte: un cliente que no responde al cierre no
+            # retrasa a los grupos siguientes
+            for connection in fallidas:
+                self._en_segundo_plano(self.cerrar(connection))
+            await asyncio.sleep(0)
+
+    def publicar_progreso(self, message: dict):
+        """Encola el mensaje para enviarlo en segundo plano y vuelve de inmediato.
         
-        for conn in disconnected:
-            self.disconnect(conn)
+        Hay una sola tarea de envío; si todavía está enviando un mensaje anterior,
+        sólo se conserva el más reciente, así que los clientes reciben los
+        mensajes en orden y el último siempre llega.
+        """
+        self._pendiente = message
+        if self._envio is None or self._envio.done():
+            self._envio = self._en_segundo_plano(self._enviar_pendientes())
+
+    async def _enviar_pendientes(self):
+        while self._pendiente is not None:
+            message, self._pendiente = self._pendiente, None
+            await self.send_progress(message)
+
+    def _en_segundo_plano(self, coro) -> asyncio.Task:
+        tarea = asyncio.create_task(coro)
+        self._tareas.add(tarea)
+        tarea.add_done_callback(self._tareas.discard)
+        return tarea
+
+    async def cerrar(self, websocket: WebSocket):
+        """Cierra el socket de un cliente descartado para que se entere y pueda
+        reconectarse; si ya está cerrado o no responde se ignora"""
+        with suppress(Exception):
+            await asyncio.wait_for(
+                websocket.close(code=status.WS_1013_TRY_AGAIN_LATER),
+                timeout=ENVIO_TIMEOUT
+            )
 
 manager = ConnectionManager()
 
@@ -124,6 +380,10 @@ class ProductoResponse(ProductoBase):
     fecha_creacion: datetime
     fecha_actualizacion: datetime
 
+class PaginaProductos(BaseModel):
+    items: List[ProductoResponse]
+    next_cursor: Optional[int] = None
+
 class ValidacionExcel(BaseModel):
     valido: bool
     mensaje: str
@@ -131,6 +391,7 @@ class ValidacionExcel(BaseModel):
     advertencias: List[str] = []
     total_filas: int = 0
     datos_previos: List[dict] = []
+    cache_key: Optional[str] = None
 
 # ==================== ENDPOINTS BÁSICOS ====================
 
@@ -142,261 +403,455 @@ def read_root():
         "docs": "/docs"
     }
 
+# Segundos que el health check espera una conexión libre y la respuesta al ping
+SALUD_TIMEOUT = 2.0
+
 @app.get("/health", tags=["Health"])
-def health_check():
+async def health_check(request: Request):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1")
-        conn.close()
+        # Con el pool agotado acquire esperaría indefinidamente; pasado el tiempo
+        # límite la base se reporta como desconectada
+        async with request.app.state.pool.acquire(timeout=SALUD_TIMEOUT) as conn:
+            await conn.fetchval("SELECT 1", timeout=SALUD_TIMEOUT)
         return {"status": "healthy", "database": "connected"}
+    except asyncio.TimeoutError:
+        return {"status": "unhealthy", "database": "disconnected", "error": "Tiempo de espera agotado"}
     except Exception as e:
         return {"status": "unhealthy", "database": "disconnected", "error": str(e)}
 
 # ==================== ENDPOINTS DE ESTADÍSTICAS (ANTES DE {producto_id}) ====================
 
+# Respuestas de estadísticas ya serializadas, con su ETag, por endpoint. El panel
+# las consulta seguido y cambian como mucho una vez por refresco de las vistas
+ESTADISTICAS_TTL = 3
+ESTADISTICAS_CACHE = TTLCache(maxsize=8, ttl=ESTADISTICAS_TTL)
+
+def cachear_estadisticas(calcular):
+    """Convierte calcular(conn) en un endpoint que sirve su respuesta desde
+    ESTADISTICAS_CACHE y responde 304 si el If-None-Match coincide con el ETag.
+    
+    Sólo se toma una conexión del pool cuando hay que calcular la respuesta.
+    """
+    async def endpoint(request: Request):
+        entrada = ESTADISTICAS_CACHE.get(calcular.__name__)
+        if entrada is None:
+            async with conexion_db(request.app.state.pool) as conn:
+                cuerpo = _orjson_dumps(await calcular(conn))
+            etag = f'"{hashlib.blake2b(cuerpo, digest_size=8).hexdigest()}"'
+            entrada = ESTADISTICAS_CACHE[calcular.__name__] = (cuerpo, etag)
+        
+        cuerpo, etag = entrada
+        # no-cache: el navegador guarda la respuesta pero la revalida cada vez
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if request.headers.get('if-none-match') == etag:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(cuerpo, media_type='application/json', headers=headers)
+    
+    endpoint.__name__ = calcular.__name__
+    endpoint.__doc__ = calcular.__doc__
+    return endpoint
+
 @app.get("/api/productos/estadisticas", tags=["Estadísticas"])
-def obtener_estadisticas():
+@cachear_estadisticas
+async def obtener_estadisticas(conn):
     """Obtiene estadísticas generales del inventario"""
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT COUNT(*) as total FROM productos")
-        total_productos = cursor.fetchone()['total']
-        
-        cursor.execute("SELECT SUM(precio * cantidad) as valor_total FROM productos")
-        valor_total = cursor.fetchone()['valor_total'] or 0
-        
-        cursor.execute("SELECT COUNT(*) as stock_bajo FROM productos WHERE cantidad < 10")
-        stock_bajo = cursor.fetchone()['stock_bajo']
-        
-        cursor.execute("SELECT COUNT(*) as sin_stock FROM productos WHERE cantidad = 0")
-        sin_stock = cursor.fetchone()['sin_stock']
-        
-        cursor.execute("SELECT SUM(cantidad) as cantidad_total FROM productos")
-        cantidad_total = cursor.fetchone()['cantidad_total'] or 0
-        
-        cursor.execute("SELECT AVG(precio) as precio_promedio FROM productos")
-        precio_promedio = cursor.fetchone()['precio_promedio'] or 0
-        
-        cursor.execute("SELECT COUNT(DISTINCT categoria) as total_categorias FROM productos WHERE categoria IS NOT NULL AND categoria != ''")
-        total_categorias = cursor.fetchone()['total_categorias']
-        
-        return {
-            'total_productos': total_productos,
-            'valor_total_inventario': round(valor_total, 2),
-            'stock_bajo': stock_bajo,
-            'sin_stock': sin_stock,
-            'cantidad_total_items': int(cantidad_total),
-            'precio_promedio': round(precio_promedio, 2),
-            'total_categorias': total_categorias
-        }
-    finally:
-        conn.close()
+    stats = await conn.fetchrow("SELECT * FROM mv_stats_productos")
+    
+    return {
+        'total_productos': stats['total'],
+        'valor_total_inventario': round(stats['valor_total'], 2),
+        'stock_bajo': stats['stock_bajo'],
+        'sin_stock': stats['sin_stock'],
+        'cantidad_total_items': int(stats['cantidad_total']),
+        'precio_promedio': round(stats['precio_promedio'], 2),
+        'total_categorias': stats['total_categorias']
+    }
 
 @app.get("/api/productos/graficas/categorias", tags=["Estadísticas"])
-def obtener_productos_por_categoria():
+@cachear_estadisticas
+async def obtener_productos_por_categoria(conn):
     """Obtiene cantidad de productos por categoría"""
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT 
-                COALESCE(NULLIF(categoria, ''), 'Sin categoría') as categoria,
-                COUNT(*) as cantidad,
-                SUM(precio * cantidad) as valor_total
-            FROM productos
-            GROUP BY categoria
-            ORDER BY cantidad DESC
-        """)
-        resultados = cursor.fetchall()
-        
-        return {
-            'categorias': [r['categoria'] for r in resultados],
-            'cantidades': [r['cantidad'] for r in resultados],
-            'valores': [float(r['valor_total'] or 0) for r in resultados]
-        }
-    finally:
-        conn.close()
+    resultados = await conn.fetch(
+        "SELECT categoria, cantidad, valor_total FROM mv_stats_categorias ORDER BY cantidad DESC"
+    )
+    
+    return {
+        'categorias': [r['categoria'] for r in resultados],
+        'cantidades': [r['cantidad'] for r in resultados],
+        'valores': [float(r['valor_total'] or 0) for r in resultados]
+    }
 
 @app.get("/api/productos/graficas/stock-bajo", tags=["Estadísticas"])
-def obtener_productos_stock_bajo():
+@cachear_estadisticas
+async def obtener_productos_stock_bajo(conn):
     """Obtiene productos con stock bajo"""
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT codigo, nombre, cantidad, precio
-            FROM productos
-            WHERE cantidad < 10
-            ORDER BY cantidad ASC
-            LIMIT 10
-        """)
-        resultados = cursor.fetchall()
-        
-        return {
-            'productos': [r['nombre'] for r in resultados],
-            'cantidades': [r['cantidad'] for r in resultados],
-            'codigos': [r['codigo'] for r in resultados]
-        }
-    finally:
-        conn.close()
+    resultados = await conn.fetch("""
+        SELECT codigo, nombre, cantidad, precio
+        FROM productos
+        WHERE cantidad < 10
+        ORDER BY cantidad ASC
+        LIMIT 10
+    """)
+    
+    return {
+        'productos': [r['nombre'] for r in resultados],
+        'cantidades': [r['cantidad'] for r in resultados],
+        'codigos': [r['codigo'] for r in resultados]
+    }
 
 @app.get("/api/productos/graficas/top-productos", tags=["Estadísticas"])
-def obtener_top_productos():
+@cachear_estadisticas
+async def obtener_top_productos(conn):
     """Obtiene los productos más valiosos"""
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT 
-                codigo, nombre, cantidad, precio,
-                (precio * cantidad) as valor_total
-            FROM productos
-            ORDER BY valor_total DESC
-            LIMIT 10
-        """)
-        resultados = cursor.fetchall()
-        
-        return {
-            'productos': [r['nombre'] for r in resultados],
-            'valores': [float(r['valor_total']) for r in resultados],
-            'cantidades': [r['cantidad'] for r in resultados],
-            'precios': [float(r['precio']) for r in resultados]
-        }
-    finally:
-        conn.close()
+    resultados = await conn.fetch("""
+        SELECT 
+            codigo, nombre, cantidad, precio,
+            (precio * cantidad) as valor_total
+        FROM productos
+        ORDER BY valor_total DESC
+        LIMIT 10
+    """)
+    
+    return {
+        'productos': [r['nombre'] for r in resultados],
+        'valores': [float(r['valor_total']) for r in resultados],
+        'cantidades': [r['cantidad'] for r in resultados],
+        'precios': [float(r['precio']) for r in resultados]
+    }
 
 @app.get("/api/productos/graficas/distribucion-precios", tags=["Estadísticas"])
-def obtener_distribucion_precios():
+@cachear_estadisticas
+async def obtener_distribucion_precios(conn):
     """Obtiene la distribución de productos por rangos de precio"""
-    conn = get_db_connection()
+    resultados = await conn.fetch("SELECT rango, cantidad FROM mv_stats_rangos_precio ORDER BY orden")
+    
+    return {
+        'rangos': [r['rango'] for r in resultados],
+        'cantidades': [r['cantidad'] for r in resultados]
+    }
+
+# ==================== ENDPOINTS EXCEL ====================
+
+COLUMNAS_PRODUCTO = ['codigo', 'nombre', 'descripcion', 'cantidad', 'precio', 'categoria']
+COLUMNAS_REQUERIDAS = ['codigo', 'nombre', 'cantidad', 'precio']
+
+# Límites de las columnas de productos en init.sql
+LIMITES_TEXTO = [('codigo', 50, 'El código'), ('nombre', 200, 'El nombre'), ('categoria', 100, 'La categoría')]
+CANTIDAD_MAXIMA = 2**31 - 1
+PRECIO_MAXIMO = 99999999.99
+
+# Los mensajes de progreso usan claves cortas: p (porcentaje), n (procesados),
+# t (total), e (exitosos), f (fallidos) y c (completado); el cliente arma el texto
+
+# Segundos mínimos entre dos mensajes de progreso durante una carga; además
+# sólo se envía un mensaje cuando el porcentaje avanzó
+PROGRESO_INTERVALO = 0.1
+
+# A partir de este número de filas la carga usa COPY en lugar de INSERTs por lotes
+COPY_MIN_FILAS = 5000
+
+# Filas de la hoja que se acumulan antes de convertirlas en un bloque del DataFrame
+LECTURA_BLOQUE = 5000
+
+# DataFrames leídos en validar-excel, indexados por el hash del archivo, para que
+# cargar-excel no tenga que volver a parsearlo
+EXCEL_CACHE = TTLCache(maxsize=8, ttl=300)
+
+async def verificar_archivo(file: UploadFile) -> str:
+    """Recorre el archivo subido por bloques y devuelve su hash, que es la clave
+    de EXCEL_CACHE.
+    
+    Cuando se llama, Starlette ya recibió el archivo completo en un
+    SpooledTemporaryFile (que pasa a disco al crecer), así que el 413 de aquí no
+    ahorra la subida: el cuerpo ya lo limitó LimiteTamanoExcel y aquí sólo se
+    rechaza el archivo que excede MAX_EXCEL_SIZE dentro del margen del multipart.
+    """
+    hash_archivo = hashlib.blake2b(digest_size=16)
+    tamano = 0
+    while chunk := await file.read(1 << 20):
+        tamano += len(chunk)
+        if tamano > MAX_EXCEL_SIZE:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail="El archivo excede el tamaño máximo de 10 MB"
+            )
+        hash_archivo.update(chunk)
+    await file.seek(0)
+    return hash_archivo.hexdigest()
+
+# Caracteres que se eliminan de los encabezados: espacios y espacios de no separación
+_SIN_ESPACIOS = str.maketrans('', '', ' \xa0')
+
+def normalizar_columna(col):
+    return str(col).lower().strip().translate(_SIN_ESPACIOS)
+
+def _valor_celda(valor):
+    """calamine devuelve '' en las celdas vacías y float en todos los números;
+    se llevan a None y a int (si no tienen decimales) como los deja pandas"""
+    if valor == '':
+        return None
+    if isinstance(valor, float) and valor.is_integer():
+        return int(valor)
+    return valor
+
+def leer_excel(archivo):
+    """Lee la primera hoja del archivo (.xlsx o .xls) en un DataFrame con columnas
+    normalizadas.
+    
+    La hoja se parsea con calamine (Rust) y sus filas se convierten en bloques de
+    LECTURA_BLOQUE filas para no mantener a la vez todas las tuplas y el
+    DataFrame. El índice conserva la posición de cada fila en la hoja.
+    """
+    libro = CalamineWorkbook.from_filelike(archivo)
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT 
-                CASE 
-                    WHEN precio < 50 THEN '< $50'
-                    WHEN precio < 100 THEN '$50 - $100'
-                    WHEN precio < 500 THEN '$100 - $500'
-                    WHEN precio < 1000 THEN '$500 - $1000'
-                    ELSE '> $1000'
-                END as rango,
-                COUNT(*) as cantidad
-            FROM productos
-            GROUP BY rango
-            ORDER BY 
-                CASE 
-                    WHEN precio < 50 THEN 1
-                    WHEN precio < 100 THEN 2
-                    WHEN precio < 500 THEN 3
-                    WHEN precio < 1000 THEN 4
-                    ELSE 5
-                END
-        """)
-        resultados = cursor.fetchall()
+        filas = (
+            tuple(_valor_celda(valor) for valor in fila)
+            for fila in libro.get_sheet_by_index(0).iter_rows()
+        )
+        encabezado = next(filas, ())
+        columnas = [
+            normalizar_columna(col) if col is not None else f'unnamed:{i}'
+            for i, col in enumerate(encabezado)
+        ]
+        n = len(columnas)
+        fila_vacia = (None,) * n
         
-        return {
-            'rangos': [r['rango'] for r in resultados],
-            'cantidades': [r['cantidad'] for r in resultados]
-        }
+        bloques = []
+        bloque = []
+        vacias_pendientes = 0
+        for fila in filas:
+            if all(valor is None for valor in fila[:n]):
+                # Las filas vacías sólo se agregan si después aparece una con datos:
+                # las del final de la hoja no cuentan, igual que en pd.read_excel
+                vacias_pendientes += 1
+                continue
+            if vacias_pendientes:
+                bloque.extend([fila_vacia] * vacias_pendientes)
+                vacias_pendientes = 0
+            bloque.append(fila[:n] + (None,) * (n - len(fila)))
+            
+            if len(bloque) >= LECTURA_BLOQUE:
+                bloques.append(pd.DataFrame.from_records(bloque, columns=columnas))
+                bloque = []
     finally:
-        conn.close()
+        libro.close()
+    
+    if bloque or not bloques:
+        bloques.append(pd.DataFrame.from_records(bloque, columns=columnas))
+    return pd.concat(bloques, ignore_index=True) if len(bloques) > 1 else bloques[0]
 
-# ==================== ENDPOINTS EXCEL ====================
+async def cargar_con_copy(conn, columnas):
+    """Carga los valores (una lista por columna de COLUMNAS_PRODUCTO) con COPY a
+    una tabla temporal y los fusiona en productos.
+    
+    Debe llamarse dentro de una transacción. Devuelve la tupla (creados, actualizados).
+    """
+    await conn.execute("""
+        CREATE TEMP TABLE productos_staging (
+            codigo VARCHAR(50),
+            nombre VARCHAR(200),
+            descripcion TEXT,
+            cantidad INTEGER,
+            precio DOUBLE PRECISION,
+            categoria VARCHAR(100)
+        ) ON COMMIT DROP
+    """)
+    
+    await conn.copy_records_to_table(
+        'productos_staging',
+        records=zip(*columnas),
+        columns=COLUMNAS_PRODUCTO
+    )
+    
+    # Las filas que ya existen con los mismos valores no se reescriben: volver a
+    # subir el mismo archivo no genera versiones muertas de cada fila ni WAL.
+    # Todo lo que no se insertó existía y cuenta como actualizado
+    creados = await conn.fetchval("""
+        WITH upsert AS (
+            INSERT INTO productos (codigo, nombre, descripcion, cantidad, precio, categoria)
+            SELECT codigo, nombre, descripcion, cantidad, precio, categoria
+            FROM productos_staging
+            ON CONFLICT (codigo) DO UPDATE SET
+                nombre = EXCLUDED.nombre,
+                descripcion = EXCLUDED.descripcion,
+                cantidad = EXCLUDED.cantidad,
+                precio = EXCLUDED.precio,
+                categoria = EXCLUDED.categoria
+            WHERE (productos.nombre, productos.descripcion, productos.cantidad, productos.precio, productos.categoria)
+                IS DISTINCT FROM (EXCLUDED.nombre, EXCLUDED.descripcion, EXCLUDED.cantidad, EXCLUDED.precio, EXCLUDED.categoria)
+            RETURNING (xmax = 0) AS insertado
+        )
+        SELECT COUNT(*) FILTER (WHERE insertado) FROM upsert
+    """)
+    return creados, len(columnas[0]) - creados
 
-@app.post("/api/productos/validar-excel", response_model=ValidacionExcel, tags=["Productos"])
-async def validar_excel(file: UploadFile = File(...)):
-    MAX_SIZE = 10 * 1024 * 1024
-    contents = await file.read()
+def validaciones_limites(df, cantidades, precios):
+    """Máscaras de las filas que exceden los límites de las columnas de productos
+    (VARCHAR, INTEGER y DECIMAL(10, 2)), con su mensaje de error"""
+    validaciones = [
+        (df[col].astype(str).str.strip().str.len() > limite, f"{etiqueta} no puede superar {limite} caracteres")
+        for col, limite, etiqueta in LIMITES_TEXTO
+        if col in df.columns
+    ]
+    validaciones += [
+        (cantidades > CANTIDAD_MAXIMA, f"La cantidad no puede superar {CANTIDAD_MAXIMA}"),
+        (precios.round(2) > PRECIO_MAXIMO, f"El precio no puede superar {PRECIO_MAXIMO}"),
+    ]
+    return validaciones
+
+def validar_dataframe(df, cache_key):
+    """Valida las columnas y filas de un Excel ya leído y arma la vista previa"""
+    errores = []
+    advertencias = []
+    
+    columnas_presentes = list(df.columns)
+    
+    for col in COLUMNAS_REQUERIDAS:
+        if col not in columnas_presentes:
+            errores.append(f"Falta la columna requerida: '{col}'")
+    
+    if errores:
+        return ValidacionExcel(
+            valido=False,
+            mensaje="El archivo tiene errores de estructura",
+            errores=errores,
+            advertencias=[f"Columnas encontradas: {', '.join(columnas_presentes)}"],
+            total_filas=len(df)
+        )
     
-    if len(contents) > MAX_SIZE:
+    filas_vacias = df.isnull().all(axis=1).sum()
+    if filas_vacias > 0:
+        advertencias.append(f"Se encontraron {filas_vacias} filas vacías que serán ignoradas")
+        df = df.dropna(how='all')
+    
+    cantidades = pd.to_numeric(df['cantidad'], errors='coerce')
+    precios = pd.to_numeric(df['precio'], errors='coerce')
+    
+    # Cada validación se evalúa sobre la columna completa; el orden de la lista
+    # define el orden de los mensajes dentro de una misma fila
+    validaciones = [
+        (df['codigo'].isna() | df['codigo'].astype(str).str.strip().eq(''), "El código no puede estar vacío"),
+        (df['nombre'].isna() | df['nombre'].astype(str).str.strip().eq(''), "El nombre no puede estar vacío"),
+        (cantidades.isna(), "La cantidad debe ser un número"),
+        (cantidades < 0, "La cantidad no puede ser negativa"),
+        (precios.isna(), "El precio debe ser un número"),
+        (precios <= 0, "El precio debe ser mayor a 0"),
+    ] + validaciones_limites(df, cantidades, precios)
+    
+    mascaras = np.column_stack([mascara.to_numpy(dtype=bool) for mascara, _ in validaciones])
+    
+    # Sólo se formatean las primeras filas con error; el resto del archivo no
+    # se recorre en Python
+    errores = []
+    for pos in np.flatnonzero(mascaras.any(axis=1))[:10]:
+        for orden in np.flatnonzero(mascaras[pos]):
+            errores.append(f"Fila {df.index[pos] + 2}: {validaciones[orden][1]}")
+    
+    if len(errores) >= 10:
+        total_errores = int(mascaras.sum())
+        errores = errores[:10]
+        if total_errores > 10:
+            errores.append(f"... y {total_errores - 10} errores más")
+    
+    # La vista previa reutiliza las columnas numéricas ya convertidas: un valor
+    # no numérico se muestra como 0 y queda reportado en errores
+    previos = df.head(5)
+    sin_valor = pd.Series('', index=previos.index)
+    datos_previos = pd.DataFrame({
+        'codigo': previos['codigo'].fillna('').astype(str),
+        'nombre': previos['nombre'].fillna('').astype(str),
+        'descripcion': previos.get('descripcion', sin_valor).fillna('').astype(str),
+        'cantidad': cantidades.head(5).fillna(0).astype(int),
+        'precio': precios.head(5).fillna(0).astype(float),
+        'categoria': previos.get('categoria', sin_valor).fillna('').astype(str)
+    }).to_dict('records')
+    
+    return ValidacionExcel(
+        valido=len(errores) == 0,
+        mensaje="Validación exitosa" if len(errores) == 0 else "Se encontraron errores",
+        errores=errores,
+        advertencias=advertencias,
+        total_filas=len(df),
+        datos_previos=datos_previos,
+        cache_key=cache_key
+    )
+
+def preparar_carga(df):
+    """Descarta las filas inválidas o repetidas y convierte los tipos por columna.
+    
+    Devuelve los valores como una lista por columna de COLUMNAS_PRODUCTO, junto
+    con el total de filas, las fallidas y el detalle de las primeras fallidas.
+    """
+    # cargar-excel puede recibir un archivo que no pasó por validar-excel
+    faltantes = [col for col in COLUMNAS_REQUERIDAS if col not in df.columns]
+    if faltantes:
         raise HTTPException(
-            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-            detail="El archivo excede el tamaño máximo de 10 MB"
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Falta la columna requerida: '{faltantes[0]}'" if len(faltantes) == 1
+            else f"Faltan las columnas requeridas: {', '.join(repr(col) for col in faltantes)}"
         )
     
+    df = df.dropna(how='all')
+    
+    for col in ('descripcion', 'categoria'):
+        if col not in df.columns:
+            df[col] = ''
+    
+    total = len(df)
+    errores_detalle = []
+    
+    cantidades = pd.to_numeric(df['cantidad'], errors='coerce')
+    precios = pd.to_numeric(df['precio'], errors='coerce')
+    # Las mismas restricciones que la tabla: una fila que las viole haría fallar
+    # el lote completo en la base, así que se descarta y se cuenta como fallida
+    invalidas = (
+        df['codigo'].isna() | df['codigo'].astype(str).str.strip().eq('')
+        | df['nombre'].isna() | df['nombre'].astype(str).str.strip().eq('')
+        | cantidades.isna() | (cantidades < 0)
+        | precios.isna() | (precios < 0)
+    )
+    for mascara, _ in validaciones_limites(df, cantidades, precios):
+        invalidas |= mascara
+    fallidos = int(invalidas.sum())
+    for idx in df.index[invalidas][:10]:
+        errores_detalle.append(f"Fila {idx + 2}: Datos faltantes o inválidos")
+    
+    validas = ~invalidas
+    df = df[validas].assign(
+        codigo=df.loc[validas, 'codigo'].astype(str).str.strip(),
+        nombre=df.loc[validas, 'nombre'].astype(str).str.strip(),
+        descripcion=df.loc[validas, 'descripcion'].fillna('').astype(str),
+        cantidad=cantidades[validas].astype(int),
+        precio=precios[validas].astype(float),
+        categoria=df.loc[validas, 'categoria'].fillna('').astype(str).str.strip()
+    )
+    # Si un código se repite en el archivo prevalece la última fila, igual que
+    # al procesar fila por fila
+    df = df.drop_duplicates(subset='codigo', keep='last')
+    
+    # Los tipos ya se convirtieron por columna; se extraen una sola vez como
+    # listas de valores nativos de Python para ambos caminos de carga
+    columnas = [df[col].tolist() for col in COLUMNAS_PRODUCTO]
+    return columnas, total, fallidos, errores_detalle
+
+
+@app.post("/api/productos/validar-excel", response_model=ValidacionExcel, tags=["Productos"])
+async def validar_excel(file: UploadFile = File(...)):
     if not file.filename.endswith(('.xlsx', '.xls')):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="El archivo debe ser un Excel (.xlsx o .xls)"
         )
     
+    cache_key = await verificar_archivo(file)
+    
     try:
-        df = pd.read_excel(io.BytesIO(contents))
-        df.columns = [str(col).lower().strip().replace('\xa0', '').replace(' ', '') for col in df.columns]
-        
-        errores = []
-        advertencias = []
-        
-        columnas_requeridas = ['codigo', 'nombre', 'cantidad', 'precio']
-        columnas_presentes = list(df.columns)
-        
-        for col in columnas_requeridas:
-            if col not in columnas_presentes:
-                errores.append(f"Falta la columna requerida: '{col}'")
-        
-        if errores:
-            return ValidacionExcel(
-                valido=False,
-                mensaje="El archivo tiene errores de estructura",
-                errores=errores,
-                advertencias=[f"Columnas encontradas: {', '.join(columnas_presentes)}"],
-                total_filas=len(df)
-            )
-        
-        filas_vacias = df.isnull().all(axis=1).sum()
-        if filas_vacias > 0:
-            advertencias.append(f"Se encontraron {filas_vacias} filas vacías que serán ignoradas")
-            df = df.dropna(how='all')
-        
-        for idx, row in df.iterrows():
-            fila = idx + 2
-            
-            if pd.isna(row['codigo']) or str(row['codigo']).strip() == '':
-                errores.append(f"Fila {fila}: El código no puede estar vacío")
-            
-            if pd.isna(row['nombre']) or str(row['nombre']).strip() == '':
-                errores.append(f"Fila {fila}: El nombre no puede estar vacío")
-            
-            try:
-                cantidad = float(row['cantidad'])
-                if cantidad < 0:
-                    errores.append(f"Fila {fila}: La cantidad no puede ser negativa")
-            except:
-                errores.append(f"Fila {fila}: La cantidad debe ser un número")
-            
-            try:
-                precio = float(row['precio'])
-                if precio <= 0:
-                    errores.append(f"Fila {fila}: El precio debe ser mayor a 0")
-            except:
-                errores.append(f"Fila {fila}: El precio debe ser un número")
-        
-        if len(errores) > 10:
-            errores = errores[:10] + [f"... y {len(errores) - 10} errores más"]
-        
-        datos_previos = []
-        for _, row in df.head(5).iterrows():
-            datos_previos.append({
-                'codigo': str(row['codigo']),
-                'nombre': str(row['nombre']),
-                'descripcion': str(row.get('descripcion', '')),
-                'cantidad': int(row['cantidad']) if pd.notna(row['cantidad']) else 0,
-                'precio': float(row['precio']) if pd.notna(row['precio']) else 0,
-                'categoria': str(row.get('categoria', ''))
-            })
-        
-        return ValidacionExcel(
-            valido=len(errores) == 0,
-            mensaje="Validación exitosa" if len(errores) == 0 else "Se encontraron errores",
-            errores=errores,
-            advertencias=advertencias,
-            total_filas=len(df),
-            datos_previos=datos_previos
-        )
-        
+        # La lectura y la validación usan la CPU durante segundos en archivos
+        # grandes; en un hilo aparte el event loop sigue atendiendo peticiones
+        # y los mensajes de progreso por WebSocket
+        df = await asyncio.to_thread(leer_excel, file.file)
+        EXCEL_CACHE[cache_key] = df
+        return await asyncio.to_thread(validar_dataframe, df, cache_key)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -404,86 +859,111 @@ async def validar_excel(file: UploadFile = File(...)):
         )
 
 @app.post("/api/productos/cargar-excel", tags=["Productos"])
-async def cargar_excel(file: UploadFile = File(...)):
-    contents = await file.read()
+async def cargar_excel(
+    request: Request,
+    file: Optional[UploadFile] = File(None),
+    cache_key: Optional[str] = None
+):
+    df = EXCEL_CACHE.get(cache_key) if cache_key else None
+    if df is None and file is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Debe enviar el archivo Excel"
+        )
+    
+    if df is None:
+        # Un archivo ya validado se encuentra en la caché por su hash aunque el
+        # cliente no envíe cache_key
+        df = EXCEL_CACHE.get(await verificar_archivo(file))
     
     try:
-        df = pd.read_excel(io.BytesIO(contents))
-        df.columns = [col.lower().strip().replace('\xa0', '').replace(' ', '') for col in df.columns]
-        df = df.dropna(how='all')
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        total = len(df)
+        # Igual que en validar-excel, el trabajo de pandas corre fuera del event loop
+        if df is None:
+            try:
+                df = await asyncio.to_thread(leer_excel, file.file)
+            except Exception as e:
+                # Un archivo que no se puede leer es un error del cliente, no del servidor
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Error al procesar el archivo: {str(e)}"
+                )
+        columnas, total, fallidos, errores_detalle = await asyncio.to_thread(preparar_carga, df)
+        filas_validas = len(columnas[0])
         productos_creados = 0
         productos_actualizados = 0
-        fallidos = 0
-        errores_detalle = []
         
-        BATCH_SIZE = 50
-        
-        for idx, row in df.iterrows():
-            try:
-                codigo = str(row['codigo']).strip()
-                nombre = str(row['nombre']).strip()
-                descripcion = str(row.get('descripcion', ''))
-                cantidad = int(row['cantidad'])
-                precio = float(row['precio'])
-                categoria = str(row.get('categoria', ''))
-                
-                cursor.execute("SELECT id FROM productos WHERE codigo = %s", (codigo,))
-                existe = cursor.fetchone()
-                
-                if existe:
-                    cursor.execute(
-                        """
-                        UPDATE productos 
-                        SET nombre = %s, descripcion = %s, cantidad = %s, precio = %s, categoria = %s
-                        WHERE codigo = %s
-                        """,
-                        (nombre, descripcion, cantidad, precio, categoria, codigo)
-                    )
-                    productos_actualizados += 1
+        # Toda la carga es una sola transacción: o se aplican todas las filas o
+        # ninguna, y el WAL se vacía a disco una única vez, al confirmar. El COMMIT
+        # es síncrono, así que cuando la API responde la carga ya es durable
+        # La conexión se toma del pool sólo para la transacción: mientras se lee
+        # y se prepara el archivo no se le quita una conexión al resto de la API
+        async with conexion_db(request.app.state.pool) as conn:
+            async with conn.transaction():
+                if filas_validas >= COPY_MIN_FILAS:
+                    productos_creados, productos_actualizados = await cargar_con_copy(conn, columnas)
                 else:
-                    cursor.execute(
-                        """
-                        INSERT INTO productos (codigo, nombre, descripcion, cantidad, precio, categoria)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                        """,
-                        (codigo, nombre, descripcion, cantidad, precio, categoria)
-                    )
-                    productos_creados += 1
-                
-                if (idx + 1) % BATCH_SIZE == 0:
-                    conn.commit()
-                    progreso = int(((idx + 1) / total) * 100)
-                    await manager.send_progress({
-                        'progreso': progreso,
-                        'procesados': idx + 1,
-                        'total': total,
-                        'exitosos': productos_creados + productos_actualizados,
-                        'fallidos': fallidos,
-                        'mensaje': f'Procesando: {idx + 1}/{total}'
-                    })
+                    PAGE_SIZE = 500
+                    ultimo_envio = 0.0
+                    ultimo_progreso = -1
                 
-            except Exception as e:
-                fallidos += 1
-                errores_detalle.append(f"Fila {idx + 2}: {str(e)}")
-                if fallidos > 10:
-                    break
-        
-        conn.commit()
-        conn.close()
+                    for inicio in range(0, filas_validas, PAGE_SIZE):
+                        lote = [valores[inicio:inicio + PAGE_SIZE] for valores in columnas]
+                        # Los insertados se cuentan en la base: cada lote devuelve un solo
+                        # valor en lugar de una fila por producto. Igual que con COPY, las
+                        # filas sin cambios no se reescriben
+                        creados = await conn.fetchval(
+                            """
+                            WITH upsert AS (
+                                INSERT INTO productos (codigo, nombre, descripcion, cantidad, precio, categoria)
+                                SELECT * FROM unnest(
+                                    $1::varchar[], $2::varchar[], $3::text[],
+                                    $4::integer[], $5::float8[], $6::varchar[]
+                                )
+                                ON CONFLICT (codigo) DO UPDATE SET
+                                    nombre = EXCLUDED.nombre,
+                                    descripcion = EXCLUDED.descripcion,
+                                    cantidad = EXCLUDED.cantidad,
+                                    precio = EXCLUDED.precio,
+                                    categoria = EXCLUDED.categoria
+                                WHERE (productos.nombre, productos.descripcion, productos.cantidad, productos.precio, productos.categoria)
+                                    IS DISTINCT FROM (EXCLUDED.nombre, EXCLUDED.descripcion, EXCLUDED.cantidad, EXCLUDED.precio, EXCLUDED.categoria)
+                                RETURNING (xmax = 0) AS insertado
+                            )
+                            SELECT COUNT(*) FILTER (WHERE insertado) FROM upsert
+                            """,
+                            *lote
+                        )
+                        productos_creados += creados
+                        productos_actualizados += len(lote[0]) - creados
+                    
+                        # Como máximo 10 actualizaciones por segundo y sólo si cambió
+                        # el porcentaje; el mensaje final de 100% se envía siempre
+                        procesados = inicio + len(lote[0])
+                        progreso = int((procesados / filas_validas) * 100)
+                        if progreso <= ultimo_progreso or time.monotonic() - ultimo_envio < PROGRESO_INTERVALO:
+                            continue
+                        ultimo_envio = time.monotonic()
+                        ultimo_progreso = progreso
+                        
+                        # Se publica sin esperar a los clientes: la transacción
+                        # sigue abierta y no debe depender de la red de nadie
+                        manager.publicar_progreso({
+                            'p': progreso,
+                            'n': procesados,
+                            't': total,
+                            'e': productos_creados + productos_actualizados,
+                            'f': fallidos
+                        })
+            
+        marcar_estadisticas_pendientes()
         
-        await manager.send_progress({
-            'progreso': 100,
-            'procesados': total,
-            'total': total,
-            'exitosos': productos_creados + productos_actualizados,
-            'fallidos': fallidos,
-            'mensaje': 'Carga completada',
-            'completado': True
+        manager.publicar_progreso({
+            'p': 100,
+            'n': total,
+            't': total,
+            'e': productos_creados + productos_actualizados,
+            'f': fallidos,
+            'c': True
         })
         
         return {
@@ -495,6 +975,15 @@ async def cargar_excel(file: UploadFile = File(...)):
             'errores': errores_detalle[:10]
         }
         
+    except HTTPException:
+        raise
+    except (asyncpg.IntegrityConstraintViolationError, asyncpg.DataError) as e:
+        # La carga es una sola transacción: si una fila viola una restricción
+        # de la tabla no se aplica ninguna
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"No se cargó ninguna fila: el archivo contiene datos inválidos ({e})"
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -505,8 +994,10 @@ async def cargar_excel(file: UploadFile = File(...)):
 async def websocket_progreso(websocket: WebSocket):
     await manager.connect(websocket)
     try:
+        # El cliente no envía nada: se espera en receive_text sólo para enterarse
+        # del cierre, sin despertar a la corrutina periódicamente
         while True:
-            await asyncio.sleep(1)
+            await websocket.receive_text()
     except WebSocketDisconnect:
         manager.disconnect(websocket)
     except Exception as e:
@@ -515,141 +1006,138 @@ async def websocket_progreso(websocket: WebSocket):
 
 # ==================== ENDPOINTS CRUD (DESPUÉS DE ESTADÍSTICAS) ====================
 
-@app.get("/api/productos", response_model=list[ProductoResponse], tags=["Productos"])
-def obtener_productos():
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM productos ORDER BY id DESC")
-        productos = cursor.fetchall()
-        return productos
-    finally:
-        conn.close()
+@app.get("/api/productos", response_model=PaginaProductos, tags=["Productos"])
+async def obtener_productos(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor_id: Optional[int] = Query(None, ge=1),
+    categoria: Optional[str] = None,
+    conn=Depends(get_db)
+):
+    # Paginación por clave: cada página continúa desde el último id de la anterior,
+    # así el costo no crece con la página como con OFFSET. La primary key sirve
+    # el orden e idx_categoria_id (categoria, id) el filtro por categoría
+    productos = await conn.fetch(
+        """
+        SELECT * FROM productos
+        WHERE ($1::integer IS NULL OR id < $1)
+            AND ($2::varchar IS NULL OR categoria = $2)
+        ORDER BY id DESC
+        LIMIT $3
+        """,
+        cursor_id, categoria, limit
+    )
+    items = [dict(p) for p in productos]
+    # Una página incompleta es la última
+    next_cursor = items[-1]['id'] if len(items) == limit else None
+    
+    # Las filas vienen de la base de datos y ya cumplen el esquema: se devuelven
+    # directamente sin volver a validarlas con PaginaProductos
+    return ORJSONResponse({'items': items, 'next_cursor': next_cursor})
 
 @app.get("/api/productos/{producto_id}", response_model=ProductoResponse, tags=["Productos"])
-def obtener_producto(producto_id: int):
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM productos WHERE id = %s", (producto_id,))
-        producto = cursor.fetchone()
-        
-        if not producto:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Producto con ID {producto_id} no encontrado"
-            )
-        
-        return producto
-    finally:
-        conn.close()
+async def obtener_producto(producto_id: int, conn=Depends(get_db)):
+    producto = await conn.fetchrow("SELECT * FROM productos WHERE id = $1", producto_id)
+    
+    if not producto:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Producto con ID {producto_id} no encontrado"
+        )
+    
+    return dict(producto)
 
 @app.post("/api/productos", response_model=ProductoResponse, status_code=status.HTTP_201_CREATED, tags=["Productos"])
-def crear_producto(producto: ProductoCreate):
-    conn = get_db_connection()
+async def crear_producto(producto: ProductoCreate, conn=Depends(get_db)):
     try:
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT id FROM productos WHERE codigo = %s", (producto.codigo,))
-        if cursor.fetchone():
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="El código del producto ya existe"
-            )
-        
-        cursor.execute(
+        nuevo_producto = await conn.fetchrow(
             """
             INSERT INTO productos (codigo, nombre, descripcion, cantidad, precio, categoria)
-            VALUES (%s, %s, %s, %s, %s, %s)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            ON CONFLICT (codigo) DO NOTHING
             RETURNING *
             """,
-            (producto.codigo, producto.nombre, producto.descripcion, 
-             producto.cantidad, producto.precio, producto.categoria)
+            producto.codigo, producto.nombre, producto.descripcion, 
+            producto.cantidad, producto.precio, producto.categoria
         )
-        
-        nuevo_producto = cursor.fetchone()
-        conn.commit()
-        
-        return nuevo_producto
-    except psycopg2.IntegrityError:
-        conn.rollback()
+    except asyncpg.IntegrityConstraintViolationError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Error de integridad en los datos"
         )
-    finally:
-        conn.close()
+    
+    if not nuevo_producto:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="El código del producto ya existe"
+        )
+    
+    marcar_estadisticas_pendientes()
+    return dict(nuevo_producto)
 
 @app.put("/api/productos/{producto_id}", response_model=ProductoResponse, tags=["Productos"])
-def actualizar_producto(producto_id: int, producto: ProductoUpdate):
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM productos WHERE id = %s", (producto_id,))
-        if not cursor.fetchone():
+async def actualizar_producto(producto_id: int, producto: ProductoUpdate, conn=Depends(get_db)):
+    valores = [
+        producto.codigo, producto.nombre, producto.descripcion,
+        producto.cantidad, producto.precio, producto.categoria
+    ]
+    
+    if all(valor is None for valor in valores):
+        producto_actual = await conn.fetchrow("SELECT * FROM productos WHERE id = $1", producto_id)
+        if not producto_actual:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Producto con ID {producto_id} no encontrado"
             )
-        
-        campos_actualizar = []
-        valores = []
-        
-        if producto.codigo is not None:
-            campos_actualizar.append("codigo = %s")
-            valores.append(producto.codigo)
-        if producto.nombre is not None:
-            campos_actualizar.append("nombre = %s")
-            valores.append(producto.nombre)
-        if producto.descripcion is not None:
-            campos_actualizar.append("descripcion = %s")
-            valores.append(producto.descripcion)
-        if producto.cantidad is not None:
-            campos_actualizar.append("cantidad = %s")
-            valores.append(producto.cantidad)
-        if producto.precio is not None:
-            campos_actualizar.append("precio = %s")
-            valores.append(producto.precio)
-        if producto.categoria is not None:
-            campos_actualizar.append("categoria = %s")
-            valores.append(producto.categoria)
-        
-        if not campos_actualizar:
-            cursor.execute("SELECT * FROM productos WHERE id = %s", (producto_id,))
-            return cursor.fetchone()
-        
-        valores.append(producto_id)
-        query = f"UPDATE productos SET {', '.join(campos_actualizar)} WHERE id = %s RETURNING *"
-        
-        cursor.execute(query, valores)
-        producto_actualizado = cursor.fetchone()
-        conn.commit()
-        
-        return producto_actualizado
-    finally:
-        conn.close()
-
-@app.delete("/api/productos/{producto_id}", tags=["Productos"])
-def eliminar_producto(producto_id: int):
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        
-        cursor.execute("DELETE FROM productos WHERE id = %s RETURNING *", (producto_id,))
-        producto_eliminado = cursor.fetchone()
-        
-        if not producto_eliminado:
+        return dict(producto_actual)
+    
+    # El texto del UPDATE es siempre el mismo: los campos que no vienen en la
+    # petición llegan como NULL y conservan su valor. La existencia del producto
+    # y la unicidad del código se validan en la misma sentencia; sólo si no se
+    # actualiza nada se consulta el motivo
+    producto_actualizado = await conn.fetchrow(
+        """
+        UPDATE productos SET
+            codigo = COALESCE($1, codigo),
+            nombre = COALESCE($2, nombre),
+            descripcion = COALESCE($3, descripcion),
+            cantidad = COALESCE($4, cantidad),
+            precio = COALESCE($5, precio),
+            categoria = COALESCE($6, categoria)
+        WHERE id = $7
+            AND ($1::varchar IS NULL OR NOT EXISTS (
+                SELECT 1 FROM productos WHERE codigo = $1 AND id <> $7
+            ))
+        RETURNING *
+        """,
+        *valores, producto_id
+    )
+    
+    if not producto_actualizado:
+        if not await conn.fetchval("SELECT 1 FROM productos WHERE id = $1", producto_id):
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Producto con ID {producto_id} no encontrado"
             )
-        
-        conn.commit()
-        
-        return {
-            "message": "Producto eliminado correctamente",
-            "producto": producto_eliminado
-        }
-    finally:
-        conn.close()
\ No newline at end of file
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="El código del producto ya existe"
+        )
+    
+    marcar_estadisticas_pendientes()
+    return dict(producto_actualizado)
+
+@app.delete("/api/productos/{producto_id}", tags=["Productos"])
+async def eliminar_producto(producto_id: int, conn=Depends(get_db)):
+    producto_eliminado = await conn.fetchrow("DELETE FROM productos WHERE id = $1 RETURNING *", producto_id)
+    
+    if not producto_eliminado:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Producto con ID {producto_id} no encontrado"
+        )
+    
+    marcar_estadisticas_pendientes()
+    return {
+        "message": "Producto eliminado correctamente",
+        "producto": dict(producto_eliminado)
+    }
@@ -158,7 +158,7 @@ export class CargaExcelComponent implements OnDestroy {
   ejecutarCarga(): void {
     if (!this.archivoSeleccionado) return;
 
-    this.productoService.cargarExcel(this.archivoSeleccionado).subscribe({
+    this.productoService.cargarExcel(this.archivoSeleccionado, this.validacion?.cache_key).subscribe({
       next: (resultado) => {
         console.log('✅ Respuesta recibida:', resultado);
         
@@ -262,10 +262,10 @@ export class CargaExcelComponent implements OnDestroy {
 
       this.websocket.onmessage = (event) => {
         try {
+          // Claves cortas: p (porcentaje), n (procesados), t (total), c (completado)
           const data = JSON.parse(event.data);
-          this.progreso = data.progreso || 0;
-          this.progresoMensaje = data.mensaje || 
-            `Procesados: ${data.procesados}/${data.total}`;
+          this.progreso = data.p || 0;
+          this.progresoMensaje = data.c ? 'Carga completada' : `Procesando: ${data.n}/${data.t}`;
           console.log('📨 WebSocket:', data);
         } catch (e) {
           console.error('Error al parsear WebSocket:', e);
@@ -1,8 +1,8 @@
 // src/app/services/producto.service.ts
 import { Injectable } from '@angular/core';
 import { HttpClient, HttpErrorResponse } from '@angular/common/http';
-import { Observable, throwError } from 'rxjs';
-import { catchError } from 'rxjs/operators';
+import { EMPTY, Observable, throwError } from 'rxjs';
+import { catchError, expand, reduce } from 'rxjs/operators';
 import { environment } from '../../environments/environment';
 
 // Interfaces
@@ -16,6 +16,11 @@ export interface Producto {
   categoria?: string;
 }
 
+export interface PaginaProductos {
+  items: Producto[];
+  next_cursor: number | null;
+}
+
 export interface ValidacionExcel {
   valido: boolean;
   mensaje: string;
@@ -23,6 +28,7 @@ export interface ValidacionExcel {
   total_filas: number;
   datos_previos: Producto[];
   advertencias?: string[];
+  cache_key?: string;
 }
 
 export interface ResultadoCarga {
@@ -40,13 +46,27 @@ export interface ResultadoCarga {
 export class ProductoService {
   private apiUrl = 'http://localhost:8000/api';
   private wsUrl = 'ws://localhost:8000';
+  private productosPorPeticion = 1000;
 
   constructor(private http: HttpClient) { }
 
   // ==================== ENDPOINTS BÁSICOS ====================
 
   obtenerProductos(): Observable<Producto[]> {
-    return this.http.get<Producto[]>(`${this.apiUrl}/productos`).pipe(
+    // Se carga la tabla completa a propósito: la lista de productos busca por
+    // texto en varios campos y numera sus páginas en el cliente, y la API no
+    // ofrece ni búsqueda por texto ni total de páginas. La API devuelve los
+    // productos por páginas; cada una indica el cursor de la siguiente y se
+    // piden hasta que no queda ninguna
+    const limit = this.productosPorPeticion;
+    const pagina = (cursor: number | null) =>
+      this.http.get<PaginaProductos>(`${this.apiUrl}/productos`, {
+        params: cursor ? { limit, cursor_id: cursor } : { limit }
+      });
+
+    return pagina(null).pipe(
+      expand(respuesta => respuesta.next_cursor ? pagina(respuesta.next_cursor) : EMPTY),
+      reduce((todos, respuesta) => todos.concat(respuesta.items), [] as Producto[]),
       catchError(this.handleError)
     );
   }
@@ -89,13 +109,16 @@ export class ProductoService {
     );
   }
 
-  cargarExcel(archivo: File): Observable<ResultadoCarga> {
+  cargarExcel(archivo: File, cacheKey?: string): Observable<ResultadoCarga> {
     const formData = new FormData();
     formData.append('file', archivo);
 
+    const params: Record<string, string> = cacheKey ? { cache_key: cacheKey } : {};
+
     return this.http.post<ResultadoCarga>(
       `${this.apiUrl}/productos/cargar-excel`,
-      formData
+      formData,
+      { params }
     ).pipe(
       catchError(this.handleError)
     );